@@ -13,14 +13,15 @@ __status__ = "Development"
 """Contains functions used in the most_wanted_otus.py script."""
 
 from collections import defaultdict
-from itertools import cycle
-from operator import itemgetter
+from heapq import nsmallest
+from multiprocessing import cpu_count, Pool
 from os import makedirs
 from os.path import basename, join, normpath, splitext
 from pickle import dump
 from tempfile import NamedTemporaryFile
 
-from pylab import axes, figlegend, figure, legend, pie, savefig
+from numpy import argsort, asarray, float64
+from pylab import axes, close, figlegend, figure, legend, pie, savefig
 
 from biom.parse import parse_biom_table
 
@@ -39,6 +40,19 @@ from qiime.workflow.util import generate_log_fp, WorkflowError, WorkflowLogger
 
 html_header = '<html lang="en"><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"> <title>Most Wanted OTUs</title><link rel="stylesheet" type="text/css" href="most_wanted_otus.css"></head><body>'
 html_footer = '</body></html>'
+pie_chart_colors = tuple([data_colors[color].toHex()
+                          for color in data_color_order])
+
+# Commands that are run for each input OTU table.
+filter_novel_otus_cmd = 'filter_otus_from_otu_table.py -i %s -o %s -e %s'
+filter_abundant_otus_cmd = ('filter_otus_from_otu_table.py -i %s -o %s -n %d '
+                            '-x %d')
+filter_known_samples_cmd = ('filter_samples_from_otu_table.py -i %s -o %s '
+                            '--sample_id_fp %s')
+collapse_by_category_cmd = 'summarize_otu_by_cat.py -c %s -o %s -m %s -i %s'
+
+legend_item_template = ('<li><div class="key" style="background-color:%s">'
+                        '</div>%s</li>')
 
 def generate_most_wanted_list(output_dir, otu_table_fps, rep_set_fp, gg_fp,
         nt_fp, mapping_fp, mapping_category, top_n, min_abundance,
@@ -72,16 +86,19 @@ def generate_most_wanted_list(output_dir, otu_table_fps, rep_set_fp, gg_fp,
     # top n.
     logger.write("Reading in BLAST results, sorting by percent identity, "
                  "and picking the top %d OTUs.\n\n" % top_n)
-    top_n_mw = _get_top_n_blast_results(open(blast_results_fp, 'U'), top_n,
-                                        max_nt_similarity)
+    with open(blast_results_fp, 'U') as blast_results_f:
+        top_n_mw = _get_top_n_blast_results(blast_results_f, top_n,
+                                            max_nt_similarity)
 
     # Read in our filtered down candidate seqs file and latest filtered and
     # collapsed OTU table. We'll need to compute some stats on these to include
     # in our report.
     logger.write("Reading in filtered candidate sequences and latest filtered "
                  "and collapsed OTU table.\n\n")
-    mw_seqs = _get_rep_set_lookup(open(rep_set_cands_failures_fp, 'U'))
-    master_otu_table_ms = parse_biom_table(open(master_otu_table_ms_fp, 'U'))
+    with open(rep_set_cands_failures_fp, 'U') as rep_set_cands_failures_f:
+        mw_seqs = _get_rep_set_lookup(rep_set_cands_failures_f)
+    with open(master_otu_table_ms_fp, 'U') as master_otu_table_ms_f:
+        master_otu_table_ms = parse_biom_table(master_otu_table_ms_f)
 
     # Write results out to tsv and HTML table.
     logger.write("Writing most wanted OTUs results to TSV and HTML "
@@ -97,7 +114,8 @@ def generate_most_wanted_list(output_dir, otu_table_fps, rep_set_fp, gg_fp,
     tsv_lines, html_table_lines, mw_fasta_lines, plot_fps, plot_data_fps = \
             _format_top_n_results_table(top_n_mw,
                 mw_seqs, master_otu_table_ms, output_img_dir, mapping_category,
-                suppress_taxonomic_output, num_categories_to_plot)
+                suppress_taxonomic_output, num_categories_to_plot,
+                jobs_to_start)
 
     mw_tsv_rel_fp = 'most_wanted_otus.txt'
     mw_tsv_fp = join(output_dir, mw_tsv_rel_fp)
@@ -136,7 +154,7 @@ def _get_most_wanted_filtering_commands(output_dir, otu_table_fps, rep_set_fp,
             novel_otu_table_fp = join(output_dir, add_filename_suffix(otu_table_fp,
                                                                       '_novel'))
             commands.append([('Filtering out all GG reference OTUs',
-                    'filter_otus_from_otu_table.py -i %s -o %s -e %s' %
+                    filter_novel_otus_cmd %
                     (otu_table_fp, novel_otu_table_fp, gg_fp))])
 
             # Next filter to keep only abundant otus in the specified range
@@ -147,7 +165,7 @@ def _get_most_wanted_filtering_commands(output_dir, otu_table_fps, rep_set_fp,
                     (min_abundance, max_abundance)))
             commands.append([('Filtering out all OTUs that do not fall within the '
                     'specified abundance threshold',
-                    'filter_otus_from_otu_table.py -i %s -o %s -n %d -x %d' %
+                    filter_abundant_otus_cmd %
                     (novel_otu_table_fp, novel_abund_otu_table_fp, min_abundance,
                      max_abundance))])
 
@@ -157,8 +175,7 @@ def _get_most_wanted_filtering_commands(output_dir, otu_table_fps, rep_set_fp,
                     '_known_samples'))
             commands.append([('Filtering out samples that are not in the mapping '
                     'file',
-                    'filter_samples_from_otu_table.py -i %s -o %s '
-                    '--sample_id_fp %s' % (novel_abund_otu_table_fp,
+                    filter_known_samples_cmd % (novel_abund_otu_table_fp,
                         novel_abund_filtered_otu_table_fp, mapping_fp))])
 
             # Next, collapse by mapping_category.
@@ -166,7 +183,7 @@ def _get_most_wanted_filtering_commands(output_dir, otu_table_fps, rep_set_fp,
                     add_filename_suffix(novel_abund_filtered_otu_table_fp, '_%s' %
                     mapping_category))
             commands.append([('Collapsing OTU table by %s' % mapping_category,
-                    'summarize_otu_by_cat.py -c %s -o %s -m %s -i %s' %
+                    collapse_by_category_cmd %
                     (novel_abund_filtered_otu_table_fp, otu_table_by_samp_type_fp,
                      mapping_category, mapping_fp))])
             otu_tables_to_merge.append(otu_table_by_samp_type_fp)
@@ -236,58 +253,86 @@ def _get_most_wanted_filtering_commands(output_dir, otu_table_fps, rep_set_fp,
            master_otu_table_ms_fp
 
 def _get_top_n_blast_results(blast_results_f, top_n, max_nt_similarity):
-    """blast_results should only contain a single hit per query sequence"""
-    result = []
-    seen_otus = {}
+    """blast_results should only contain a single hit per query sequence
+
+    blast_results_f can be an open file or any other iterable of lines. It is
+    consumed lazily in a single pass, so the BLAST output is never read into
+    memory all at once.
+    """
+    # Keep the hits in parallel lists rather than a list of tuples, and only
+    # build tuples for the top n hits that we actually return.
+    otu_ids = []
+    subject_ids = []
+    percent_identities = []
+    seen_otus = set()
     for line in blast_results_f:
         # Skip headers and comments.
         line = line.strip()
         if line and not line.startswith('#'):
-            otu_id, subject_id, percent_identity = line.split('\t')[:3]
+            # We only need the first three fields, so don't bother splitting
+            # the rest of the (12-column) line.
+            otu_id, subject_id, percent_identity = line.split('\t', 3)[:3]
             percent_identity = float(percent_identity)
 
             # Skip otus that are too similar to their subject, and skip
-            # duplicate query hits.
+            # duplicate query hits. BLAST reports hits in rank order, so we
+            # keep the best-ranked hit that passes the similarity filter.
             if ((percent_identity / 100.0) <= max_nt_similarity and
                 otu_id not in seen_otus):
-                result.append((otu_id, subject_id, percent_identity))
-                seen_otus[otu_id] = True
-    return sorted(result, key=itemgetter(2))[:top_n]
+                otu_ids.append(otu_id)
+                subject_ids.append(subject_id)
+                percent_identities.append(percent_identity)
+                seen_otus.add(otu_id)
+
+    # Equivalent to sorted(...)[:top_n] (including the order of ties), but
+    # without sorting every hit when we only want a handful.
+    top_n_idxs = nsmallest(top_n, xrange(len(percent_identities)),
+                           key=percent_identities.__getitem__)
+    return [(otu_ids[i], subject_ids[i], percent_identities[i])
+            for i in top_n_idxs]
 
 def _get_rep_set_lookup(rep_set_f):
+    # MinimalFastaParser already joins multi-line sequences in a single pass,
+    # so all that's left to do here is trim the sequence ID off the label.
     result = {}
     for seq_id, seq in MinimalFastaParser(rep_set_f):
-        seq_id = seq_id.strip().split()[0]
-        result[seq_id] = seq
+        result[seq_id.split(None, 1)[0]] = seq
     return result
 
 def _format_top_n_results_table(top_n_mw, mw_seqs, master_otu_table_ms,
                                 output_img_dir, mapping_category,
                                 suppress_taxonomic_output,
-                                num_categories_to_plot):
-    tsv_lines = ''
-    html_lines = ''
-    mw_fasta_lines = ''
+                                num_categories_to_plot, jobs_to_start=1):
+    # Build each output up as a list of pieces and join them at the end
+    # rather than repeatedly concatenating strings.
+    tsv_lines = []
+    html_lines = []
+    mw_fasta_lines = []
     plot_fps = []
     plot_data_fps = []
+    plots_to_render = []
 
-    tsv_lines += '#\tOTU ID\tSequence\t'
+    tsv_lines.append('#\tOTU ID\tSequence\t')
     if not suppress_taxonomic_output:
-        tsv_lines += 'Greengenes taxonomy\t'
-    tsv_lines += 'NCBI nt closest match\tNCBI nt % identity\n'
+        tsv_lines.append('Greengenes taxonomy\t')
+    tsv_lines.append('NCBI nt closest match\tNCBI nt % identity\n')
 
-    html_lines += ('<table id="most_wanted_otus_table" border="border">'
-                   '<tr><th>#</th><th>OTU</th>')
+    html_lines.append('<table id="most_wanted_otus_table" border="border">'
+                      '<tr><th>#</th><th>OTU</th>')
     if not suppress_taxonomic_output:
-        html_lines += '<th>Greengenes taxonomy</th>'
-    html_lines += ('<th>NCBI nt closest match</th>'
-                   '<th>Abundance by %s</th></tr>' % mapping_category)
+        html_lines.append('<th>Greengenes taxonomy</th>')
+    html_lines.append('<th>NCBI nt closest match</th>'
+                      '<th>Abundance by %s</th></tr>' % mapping_category)
+
+    # These are the same for every OTU, so only look them up once.
+    samp_types = master_otu_table_ms.SampleIds
+    obs_md = master_otu_table_ms.ObservationMetadata
 
     for mw_num, (otu_id, subject_id, percent_identity) in enumerate(top_n_mw):
         # Grab all necessary information to be included in our report.
         seq = mw_seqs[otu_id]
 
-        mw_fasta_lines += '>%s\n%s\n' % (otu_id, seq)
+        mw_fasta_lines.append('>%s\n%s\n' % (otu_id, seq))
 
         # Splitting code taken from
         # http://code.activestate.com/recipes/496784-split-string-into-n-
@@ -295,7 +340,9 @@ def _format_top_n_results_table(top_n_mw, mw_seqs, master_otu_table_ms,
         split_seq = [seq[i:i+40] for i in range(0, len(seq), 40)]
 
         if not suppress_taxonomic_output:
-            tax = master_otu_table_ms.ObservationMetadata[
+            # getObservationIndex is a dict lookup on the table's prebuilt
+            # ID -> index map, so there's no linear search here.
+            tax = obs_md[
                 master_otu_table_ms.getObservationIndex(otu_id)]['taxonomy']
 
         gb_id = subject_id.split('|')[3]
@@ -303,27 +350,19 @@ def _format_top_n_results_table(top_n_mw, mw_seqs, master_otu_table_ms,
 
         # Compute the abundance of each most wanted OTU in each sample
         # grouping and create a pie chart to go in the HTML table.
-        samp_types = master_otu_table_ms.SampleIds
+        # Rows have one entry per sample grouping, so densifying is cheap.
         counts = master_otu_table_ms.observationData(otu_id)
         plot_data = _format_pie_chart_data(samp_types, counts,
                                            num_categories_to_plot)
 
-        # Piechart code based on:
-        # http://matplotlib.sourceforge.net/examples/pylab_examples/
-        #   pie_demo.html
-        # http://www.saltycrane.com/blog/2006/12/example-pie-charts-using-
-        #   python-and/
-        figure(figsize=(8,8))
-        ax = axes([0.1, 0.1, 0.8, 0.8])
-        patches = pie(plot_data[0], colors=plot_data[2], shadow=True)
-
-        # We need a relative path to the image.
+        # We need a relative path to the image. The plot itself is rendered
+        # after we've processed all of the OTUs.
         pie_chart_filename = 'abundance_by_%s_%s.png' % (mapping_category,
                                                          otu_id)
         pie_chart_rel_fp = join(basename(normpath(output_img_dir)),
                 pie_chart_filename)
         pie_chart_abs_fp = join(output_img_dir, pie_chart_filename)
-        savefig(pie_chart_abs_fp, transparent=True)
+        plots_to_render.append((plot_data, pie_chart_abs_fp))
         plot_fps.append(pie_chart_abs_fp)
 
         # Write out pickled data for easy plot editing post-creation.
@@ -332,47 +371,86 @@ def _format_top_n_results_table(top_n_mw, mw_seqs, master_otu_table_ms,
         dump(plot_data, open(plot_data_fp, 'wb'))
         plot_data_fps.append(plot_data_fp)
 
-        tsv_lines += '%d\t%s\t%s\t' % (mw_num + 1, otu_id, seq)
+        tsv_lines.append('%d\t%s\t%s\t' % (mw_num + 1, otu_id, seq))
         if not suppress_taxonomic_output:
-            tsv_lines += '%s\t' % tax
-        tsv_lines += '%s\t%s\n' % (gb_id, percent_identity)
+            tsv_lines.append('%s\t' % tax)
+        tsv_lines.append('%s\t%s\n' % (gb_id, percent_identity))
 
-        html_lines += '<tr><td>%d</td><td><pre>&gt;%s\n%s</pre></td>' % (
-                mw_num + 1, otu_id, '\n'.join(split_seq))
+        html_lines.append('<tr><td>%d</td><td><pre>&gt;%s\n%s</pre></td>' % (
+                mw_num + 1, otu_id, '\n'.join(split_seq)))
         if not suppress_taxonomic_output:
-            html_lines += '<td>%s</td>' % tax
-        html_lines += ('<td><a href="%s" target="_blank">%s</a> '
+            html_lines.append('<td>%s</td>' % tax)
+        html_lines.append('<td><a href="%s" target="_blank">%s</a> '
                 '(%s%% sim.)</td>' % (ncbi_link, gb_id, percent_identity))
 
         # Create the legend as a table- couldn't get mpl to correctly
         # plot legend side-by-side the pie chart and don't have time to mess
         # with it anymore.
         legend_html = _format_legend_html(plot_data)
-        html_lines += ('<td><table><tr><td><img src="%s" width="300" '
+        html_lines.append('<td><table><tr><td><img src="%s" width="300" '
                 'height="300" /></td><td>%s</td></tr></table></tr>' % (
                 pie_chart_rel_fp, legend_html))
-    html_lines += '</table>'
-
-    return tsv_lines, html_lines, mw_fasta_lines, plot_fps, plot_data_fps
+    html_lines.append('</table>')
+
+    # Rendering the pie charts is by far the slowest part of this function,
+    # and each plot is independent of the others, so split them up across
+    # multiple processes if we've been asked to. jobs_to_start may be sized
+    # for a cluster, so never start more local processes than we have CPUs
+    # (or plots).
+    num_procs = min(jobs_to_start, cpu_count(), len(plots_to_render))
+    if num_procs > 1:
+        pool = Pool(processes=num_procs)
+        try:
+            pool.map(_plot_pie_chart, plots_to_render)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for plot_info in plots_to_render:
+            _plot_pie_chart(plot_info)
+
+    return (''.join(tsv_lines), ''.join(html_lines), ''.join(mw_fasta_lines),
+            plot_fps, plot_data_fps)
+
+def _plot_pie_chart(plot_info):
+    """Renders a single pie chart to a file.
+
+    Takes a single (plot_data, output_fp) tuple so that it can be used with
+    multiprocessing.Pool.map.
+    """
+    plot_data, output_fp = plot_info
+
+    # Piechart code based on:
+    # http://matplotlib.sourceforge.net/examples/pylab_examples/
+    #   pie_demo.html
+    # http://www.saltycrane.com/blog/2006/12/example-pie-charts-using-
+    #   python-and/
+    fig = figure(figsize=(8,8))
+    axes([0.1, 0.1, 0.8, 0.8])
+    pie(plot_data[0], colors=plot_data[2], shadow=True)
+    savefig(output_fp, transparent=True)
+    close(fig)
 
 def _format_pie_chart_data(labels, data, max_count):
     if len(labels) != len(data):
         raise ValueError("The number of labels does not match the number "
                          "of counts.")
-    colors = cycle([data_colors[color].toHex() for color in data_color_order])
-    result = [(val, label, colors.next()) for val, label in zip(data, labels)]
-    result = sorted(result, key=itemgetter(0), reverse=True)[:max_count]
-    total = sum([e[0] for e in result])
-    result = [(val / total, label, color) for val, label, color in result]
-    return ([e[0] for e in result],
-            ['%s (%.2f%%)' % (e[1], e[0] * 100.0) for e in result],
-            [e[2] for e in result])
+    counts = asarray(data, dtype=float64)
+
+    # Each color is chosen by the label's original index (cycling through the
+    # palette), so sorting doesn't change colors. A stable sort keeps ties in
+    # their original order.
+    order = argsort(-counts, kind='mergesort')[:max_count]
+    fracs = counts[order] / counts[order].sum()
+    return (fracs.tolist(),
+            ['%s (%.2f%%)' % (labels[i], frac * 100.0)
+             for i, frac in zip(order, fracs)],
+            [pie_chart_colors[i % len(pie_chart_colors)] for i in order])
 
 def _format_legend_html(plot_data):
-    result = '<ul class="most_wanted_otus_legend">'
-    for val, label, color in zip(plot_data[0], plot_data[1], plot_data[2]):
-        result += ('<li><div class="key" style="background-color:%s"></div>%s</li>' % (color,label))
-    return result + '</ul>'
+    return '<ul class="most_wanted_otus_legend">%s</ul>' % ''.join(
+            [legend_item_template % (color, label)
+             for label, color in zip(plot_data[1], plot_data[2])])
 
 # def _format_legend_html(plot_data):
 #     result = '<table class="most_wanted_otus_legend">'
@@ -16,13 +16,12 @@ from os import makedirs, getcwd, chdir
 from os.path import basename, exists, join, normpath
 from shutil import rmtree
 from tempfile import mkdtemp, NamedTemporaryFile
+from unittest import TestCase, main
 
-from numpy import array
+from numpy.testing import assert_allclose
 
 from biom.table import table_factory, SparseOTUTable
 from cogent.app.formatdb import build_blast_db_from_fasta_path
-from cogent.util.misc import remove_files
-from cogent.util.unit_test import TestCase, main
 from qiime.test import initiate_timeout, disable_timeout
 from qiime.util import get_qiime_temp_dir, get_tmp_filename
 from qiime.workflow.util import WorkflowError
@@ -35,42 +34,58 @@ from emp.most_wanted_otus import (generate_most_wanted_list,
 class MostWantedOtusTests(TestCase):
     """Tests for the most_wanted_otus.py module."""
 
-    def setUp(self):
-        """Set up files/environment that will be used by the tests."""
+    @classmethod
+    def setUpClass(cls):
+        """Create a shared temp dir and OTU table for the tests."""
         # The prefix to use for temporary files. This prefix may be added to,
         # but all temp dirs and files created by the tests will have this
         # prefix at a minimum.
-        self.prefix = 'most_wanted_otus_tests_'
-        self.files_to_remove = []
-        self.dirs_to_remove = []
+        cls.prefix = 'most_wanted_otus_tests_'
+        cls.tmp_dir = mkdtemp(prefix=cls.prefix)
+
+        # None of the tests modify the table, so build it once and share it.
+        # The counts are given as sparse [row, col, value] triples so that
+        # biom doesn't have to convert a dense matrix.
+        cls.master_otu_table_ms = table_factory(
+                [[0, 0, 1.0], [0, 1, 2.0], [1, 0, 2.0], [1, 1, 5.0]],
+                ['Env1', 'Env2'], ['a', 'b'],
+                sample_metadata=None,
+                observation_metadata=[{'taxonomy':'foo;bar;baz'},
+                {'taxonomy':'foo;baz;bar'}], table_id=None,
+                constructor=SparseOTUTable)
 
-        self.output_dir = mkdtemp(prefix='%soutput_dir_' % self.prefix)
-        self.dirs_to_remove.append(self.output_dir)
+    @classmethod
+    def tearDownClass(cls):
+        """Remove the temp dir (and everything the tests wrote to it)."""
+        rmtree(cls.tmp_dir)
 
+    def setUp(self):
+        """Set up data that will be used by the tests."""
         self.grouping_category = 'Environment'
-        self.top_n = 100
 
-        self.blast_results_lines = blast_results.split('\n')
-        self.blast_results_dupes_lines = blast_results_dupes.split('\n')
-        self.rep_set_lines = rep_set.split('\n')
+        self.rep_set_lines = rep_set_lines
         self.top_n_mw = [('a', 'gi|7|emb|T51700.1|', 87.0),
                          ('b', 'gi|8|emb|Z700.1|', 89.5)]
         self.mw_seqs = {'b':'AAGGTT', 'a':'AGT'}
-        self.master_otu_table_ms = table_factory(
-                array([[1.0, 2.0], [2.0, 5.0]]), ['Env1', 'Env2'], ['a', 'b'],
-                sample_metadata=None,
-                observation_metadata=[{'taxonomy':'foo;bar;baz'},
-                {'taxonomy':'foo;baz;bar'}], table_id=None,
-                constructor=SparseOTUTable)
 
-    def tearDown(self):
-        """Remove temporary files/dirs."""
-        remove_files(self.files_to_remove)
-        # remove directories last, so we don't get errors
-        # trying to remove files which may be in the directories
-        for d in self.dirs_to_remove:
-            if exists(d):
-                rmtree(d)
+    def _make_output_dir(self):
+        """Return a new output dir under the shared temp dir."""
+        return mkdtemp(prefix='%soutput_dir_' % self.prefix, dir=self.tmp_dir)
+
+    def _replace_output_dir(self, obs, output_dir):
+        """Replace the random output dir with 'foo' so output is comparable."""
+        output_dir_name = basename(normpath(output_dir))
+        return (obs[0],
+                obs[1].replace(output_dir_name, 'foo'),
+                obs[2],
+                [fp.replace(output_dir, 'foo') for fp in obs[3]],
+                [fp.replace(output_dir, 'foo') for fp in obs[4]])
+
+    def assertPieChartDataEqual(self, obs, exp):
+        """Compare fractions within a tolerance; labels/colors exactly."""
+        assert_allclose(obs[0], exp[0])
+        self.assertEqual(obs[1], exp[1])
+        self.assertEqual(obs[2], exp[2])
 
     def test_get_most_wanted_filtering_commands(self):
         obs = _get_most_wanted_filtering_commands('/foo', ['/a.biom',
@@ -86,77 +101,60 @@ class MostWantedOtusTests(TestCase):
         self.assertEqual(obs, exp_commands_merged_master_otu_table)
 
     def test_get_top_n_blast_results(self):
-        exp = [('New.CleanUp.ReferenceOTU969', 'gi|16|emb|Z52700.1|', 90.0),
-                ('New.CleanUp.ReferenceOTU999', 'gi|7|emb|X51700.1|', 100.0),
-                ('New.CleanUp.ReferenceOTU972', 'gi|7|emb|T51700.1|', 100.0)]
-        obs = _get_top_n_blast_results(self.blast_results_lines, self.top_n,
-                                       1.0)
-        self.assertFloatEqual(obs, exp)
-
-    def test_get_top_n_blast_results_max_nt_similarity(self):
-        exp = [('New.CleanUp.ReferenceOTU969', 'gi|16|emb|Z52700.1|', 90.0)]
-        obs = _get_top_n_blast_results(self.blast_results_lines, self.top_n,
-                                       0.97)
-        self.assertFloatEqual(obs, exp)
-
-        obs = _get_top_n_blast_results(self.blast_results_lines, self.top_n,
-                                       0.90)
-        self.assertFloatEqual(obs, exp)
-
-    def test_get_top_n_blast_results_duplicate_blast_hits(self):
-        exp = [('New.CleanUp.ReferenceOTU969', 'gi|16|emb|Z52700.1|', 90.0),
-               ('New.CleanUp.ReferenceOTU972', 'gi|7|emb|T51700.1|', 95.0)]
-        obs = _get_top_n_blast_results(self.blast_results_dupes_lines,
-                                       2, 1.0)
-        self.assertFloatEqual(obs, exp)
+        for blast_results_f, top_n, max_nt_similarity, exp in \
+                top_n_blast_results_cases:
+            obs = _get_top_n_blast_results(blast_results_f, top_n,
+                                           max_nt_similarity)
+            self.assertEqual(obs, exp, 'top_n=%d, max_nt_similarity=%r' %
+                             (top_n, max_nt_similarity))
 
     def test_get_rep_set_lookup(self):
         obs = _get_rep_set_lookup(self.rep_set_lines)
         self.assertEqual(obs, exp_rep_set_lookup)
 
     def test_format_top_n_results_table(self):
+        output_dir = self._make_output_dir()
         obs = _format_top_n_results_table(self.top_n_mw, self.mw_seqs,
-                self.master_otu_table_ms, self.output_dir,
+                self.master_otu_table_ms, output_dir,
                 self.grouping_category, False, 8)
 
-        obs_plot_paths = [fp.replace(self.output_dir, 'foo') for fp in obs[3]]
-        obs_plot_data_paths = [fp.replace(self.output_dir, 'foo')
-                               for fp in obs[4]]
-        obs = (obs[0],
-               obs[1].replace(basename(normpath(self.output_dir)), 'foo'),
-               obs[2],
-               obs_plot_paths,
-               obs_plot_data_paths)
+        obs = self._replace_output_dir(obs, output_dir)
         self.assertEqual(obs, exp_output_tables)
 
     def test_format_top_n_results_table_suppress_taxonomy(self):
+        output_dir = self._make_output_dir()
         obs = _format_top_n_results_table(self.top_n_mw, self.mw_seqs,
-                self.master_otu_table_ms, self.output_dir,
+                self.master_otu_table_ms, output_dir,
                 self.grouping_category, True, 8)
 
-        obs_plot_paths = [fp.replace(self.output_dir, 'foo') for fp in obs[3]]
-        obs_plot_data_paths = [fp.replace(self.output_dir, 'foo')
-                               for fp in obs[4]]
-        obs = (obs[0],
-               obs[1].replace(basename(normpath(self.output_dir)), 'foo'),
-               obs[2],
-               obs_plot_paths,
-               obs_plot_data_paths)
+        obs = self._replace_output_dir(obs, output_dir)
         self.assertEqual(obs, exp_output_tables_suppressed_taxonomy)
 
+    def test_format_top_n_results_table_parallel(self):
+        output_dir = self._make_output_dir()
+        obs = _format_top_n_results_table(self.top_n_mw, self.mw_seqs,
+                self.master_otu_table_ms, output_dir,
+                self.grouping_category, False, 8, 2)
+
+        for fp in obs[3]:
+            self.assertTrue(exists(fp))
+
+        obs = self._replace_output_dir(obs, output_dir)
+        self.assertEqual(obs, exp_output_tables)
+
     def test_format_pie_chart_data(self):
         exp = ([0.6666666666666666, 0.3333333333333333],
                ['b (66.67%)', 'a (33.33%)'], ['#0000ff', '#ff0000'])
         obs = _format_pie_chart_data(['a', 'b'], [1, 2], 2)
-        self.assertFloatEqual(obs, exp)
+        self.assertPieChartDataEqual(obs, exp)
 
         obs = _format_pie_chart_data(['a', 'b'], [1.0, 2.0], 3)
-        self.assertFloatEqual(obs, exp)
+        self.assertPieChartDataEqual(obs, exp)
 
     def test_format_pie_chart_data_max_count(self):
         exp = ([1.0], ['b (100.00%)'], ['#0000ff'])
         obs = _format_pie_chart_data(['a', 'b'], [1, 2], 1)
-        self.assertFloatEqual(obs, exp)
+        self.assertPieChartDataEqual(obs, exp)
 
     def test_format_pie_chart_data_cycle_colors(self):
         exp = ([0.5, 0.5], ['a (50.00%)', '4 (50.00%)'],
@@ -166,7 +164,7 @@ class MostWantedOtusTests(TestCase):
             'v', 'w', 'x', 'y', 'z', '1', '2', '3', '4'],
             [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
              0, 0, 0, 0, 0, 0, 0, 1], 2)
-        self.assertFloatEqual(obs, exp)
+        self.assertPieChartDataEqual(obs, exp)
 
     def test_format_legend_html(self):
         exp = ('<ul class="most_wanted_otus_legend"><li><div class="key" style="background-color:#0000ff"></div>b (66.67%)</li><li><div class="key" style="background-color:#ff0000"></div>a (33.33%)</li>'
@@ -231,6 +229,28 @@ New.CleanUp.ReferenceOTU972	gi|7|emb|T51700.1|	95.00	11	0	0	92	102	367	357	0.27
 New.CleanUp.ReferenceOTU969	gi|16|emb|Z52700.1|	90.00	13	0	0	33	45	1604	1616	0.016	26.3
 """
 
+# The parsers only iterate over these, so split them once at import time.
+rep_set_lines = tuple(rep_set.split('\n'))
+blast_results_lines = tuple(blast_results.split('\n'))
+blast_results_dupes_lines = tuple(blast_results_dupes.split('\n'))
+
+# (BLAST results, top n, max nt similarity, expected top n results).
+top_n_blast_results_cases = [
+    (blast_results_lines, 100, 1.0,
+     [('New.CleanUp.ReferenceOTU969', 'gi|16|emb|Z52700.1|', 90.0),
+      ('New.CleanUp.ReferenceOTU999', 'gi|7|emb|X51700.1|', 100.0),
+      ('New.CleanUp.ReferenceOTU972', 'gi|7|emb|T51700.1|', 100.0)]),
+    # Hits that are too similar to their subject are filtered out.
+    (blast_results_lines, 100, 0.97,
+     [('New.CleanUp.ReferenceOTU969', 'gi|16|emb|Z52700.1|', 90.0)]),
+    (blast_results_lines, 100, 0.90,
+     [('New.CleanUp.ReferenceOTU969', 'gi|16|emb|Z52700.1|', 90.0)]),
+    # Only the first hit for each query is used.
+    (blast_results_dupes_lines, 2, 1.0,
+     [('New.CleanUp.ReferenceOTU969', 'gi|16|emb|Z52700.1|', 90.0),
+      ('New.CleanUp.ReferenceOTU972', 'gi|7|emb|T51700.1|', 95.0)])
+]
+
 exp_txt = """OTU ID	Sequence	Taxonomy	NCBI nr closest match
 New.CleanUp.ReferenceOTU972	ATACGGAGGGTGCAAGCGTTAATCGGAATTACTGGGCGTAAAGGGTGCGTAGGCGGATGTTTAAGTGGGATGTGAAATCCCCGGGCTTAACCTGGGGGCTGC	foo;bar;baz	http://foo.com
 New.CleanUp.ReferenceOTU969	ATACGTAGGTCCCGAGCGTTGTCCGGATTTACTGGGTGTAAAGGGAGCGTAGACGGCATGGCAAGTCTGAAGTGAAAACCCAGGGCTCAACCCTGGGACTGC	foo;bar;baz	http://foo.com